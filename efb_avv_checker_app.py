@@ -11,9 +11,11 @@
 
 from __future__ import annotations
 
+import html
 import os
 import re
 import sqlite3
+from collections import defaultdict
 from typing import Dict, List, Optional, Tuple
 
 import streamlit as st
@@ -28,12 +30,15 @@ BRAND_NAME = ""
 APP_TITLE = "EfB-Check: AVV je Standort"
 
 
+_NON_DIGIT = re.compile(r"\D")
+
+
 # ----------------------------
 # Basics
 # ----------------------------
 
 def normalize_avv(s: str) -> Optional[str]:
-    digits = re.sub(r"\D", "", s or "")
+    digits = _NON_DIGIT.sub("", s or "")
     if len(digits) == 6:
         return digits
     if len(digits) == 5:
@@ -118,6 +123,15 @@ def inject_css():
           .bc-status .big { font-size: 1.2rem; font-weight: 820; margin-bottom: 6px; }
           .bc-status .small { color: var(--muted); font-size: 0.95rem; }
 
+          .bc-table { width: 100%; border-collapse: collapse; font-size: 0.92rem; }
+          .bc-table th, .bc-table td {
+            border-bottom: 1px solid var(--border);
+            padding: 6px 10px;
+            text-align: left;
+            vertical-align: top;
+          }
+          .bc-table th { color: var(--muted); font-weight: 600; }
+
           div[data-testid="stDataFrame"], div[data-testid="stTable"] {
             border: 1px solid var(--border);
             border-radius: 16px;
@@ -153,6 +167,18 @@ def status_block(ok: bool, headline: str, detail: str):
     )
 
 
+def render_small_table(rows: List[Dict[str, str]]) -> str:
+    # Kleine Listen als statisches HTML statt st.dataframe:
+    # spart Arrow-Serialisierung + Grid-Init bei jedem Rerun.
+    if not rows:
+        return ""
+    head = "".join(f"<th>{html.escape(str(k))}</th>" for k in rows[0].keys())
+    body = "".join(
+        "<tr>" + "".join(f"<td>{html.escape(str(v))}</td>" for v in r.values()) + "</tr>" for r in rows
+    )
+    return f"<table class='bc-table'><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>"
+
+
 def load_logo_bytes() -> Optional[bytes]:
     try:
         here = os.path.dirname(__file__)
@@ -211,6 +237,9 @@ def full_address(strasse: str, plz: str, ort: str, bundesland: str) -> str:
 def open_db(db_path: str) -> sqlite3.Connection:
     con = sqlite3.connect(db_path, check_same_thread=False)
     con.row_factory = sqlite3.Row
+    # Leselastiger Workload: größerer Page-Cache (~20 MB) + mmap-I/O.
+    con.execute("PRAGMA cache_size=-20000")
+    con.execute("PRAGMA mmap_size=268435456")
     return con
 
 
@@ -238,19 +267,72 @@ def db_get_avv_for_site(con: sqlite3.Connection, site_id: int) -> List[sqlite3.R
     return cur.fetchall()
 
 
-def db_find_avv(con: sqlite3.Connection, site_id: int, code: str) -> Optional[sqlite3.Row]:
+@st.cache_data(show_spinner=False)
+def load_meta(db_path: str, mtime: float) -> Dict[str, str]:
+    # mtime ist Teil des Cache-Keys: DB-Änderung invalidiert den Cache.
+    con = open_db(db_path)
+    return db_get_meta(con)
+
+
+@st.cache_data(show_spinner=False)
+def load_sites(db_path: str, mtime: float) -> Tuple[List[Dict], List[str], Dict[str, Dict]]:
+    con = open_db(db_path)
+    sites = [dict(r) for r in db_list_sites(con)]
+    labels = [build_site_label(s["ort"], s["bundesland"], s["annex"]) for s in sites]
+    label_to_site = {labels[i]: sites[i] for i in range(len(sites))}
+    return sites, labels, label_to_site
+
+
+@st.cache_data(show_spinner=False)
+def load_avv_for_site(db_path: str, mtime: float, site_id: int) -> List[Dict]:
+    con = open_db(db_path)
+    return [dict(r) for r in db_get_avv_for_site(con, site_id)]
+
+
+def db_overview(con: sqlite3.Connection) -> List[sqlite3.Row]:
     cur = con.cursor()
-    cur.execute("SELECT code, text FROM avv WHERE site_id=? AND code=? LIMIT 1", (site_id, code))
-    return cur.fetchone()
+    cur.execute(
+        """
+        SELECT s.ort, s.bundesland, s.annex, s.pages_start, s.pages_end,
+               s.strasse, s.plz, COUNT(a.id) AS n
+        FROM sites s
+        LEFT JOIN avv a ON a.site_id = s.id
+        GROUP BY s.id
+        ORDER BY s.ort, s.annex
+        """
+    )
+    return cur.fetchall()
 
 
-def suggest_similar(rows: List[sqlite3.Row], avv_code: str, limit: int = 10) -> List[sqlite3.Row]:
-    chap = avv_code[:2]
-    group = avv_code[:4]
-    same_group = [r for r in rows if str(r["code"]).startswith(group)]
-    same_chap = [r for r in rows if str(r["code"]).startswith(chap)]
-    out = same_group + [r for r in same_chap if r not in same_group]
-    return out[:limit]
+def build_prefix_index(rows: List[Dict]) -> Tuple[Dict[str, List[Dict]], Dict[str, List[Dict]]]:
+    # Einmal pro Standort nach 4-stelliger Gruppe und 2-stelligem Kapitel
+    # gruppieren; Vorschläge sind dann reine Dict-Lookups.
+    group_idx: Dict[str, List[Dict]] = defaultdict(list)
+    chap_idx: Dict[str, List[Dict]] = defaultdict(list)
+    for r in rows:
+        code = str(r["code"])
+        group_idx[code[:4]].append(r)
+        chap_idx[code[:2]].append(r)
+    return group_idx, chap_idx
+
+
+def suggest_similar(
+    group_idx: Dict[str, List[Dict]],
+    chap_idx: Dict[str, List[Dict]],
+    avv_code: str,
+    limit: int = 10,
+) -> List[Dict]:
+    # Gruppe-Treffer vor Kapitel-Treffer, dedupliziert über den Code.
+    seen = set()
+    out: List[Dict] = []
+    for r in group_idx.get(avv_code[:4], []) + chap_idx.get(avv_code[:2], []):
+        if r["code"] in seen:
+            continue
+        seen.add(r["code"])
+        out.append(r)
+        if len(out) >= limit:
+            break
+    return out
 
 
 # ----------------------------
@@ -274,32 +356,37 @@ def nominatim_geocode(address: str) -> Optional[Tuple[float, float]]:
 
 
 def make_map(lat: float, lon: float, tile_style: str) -> folium.Map:
-    m = folium.Map(location=[lat, lon], zoom_start=16, control_scale=True, tiles=None)
-
-    # Basemaps ohne Key
-    folium.TileLayer(
-        tiles="OpenStreetMap",
-        name="OpenStreetMap",
-        control=True,
-    ).add_to(m)
-
-    # Satellit (Esri) ohne Key (public tiles; Nutzung gemäß Esri/ArcGIS Terms)
-    folium.TileLayer(
-        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-        name="Satellit (Esri)",
-        attr="Tiles © Esri — Source: Esri, Maxar, Earthstar Geographics, and the GIS User Community",
-        control=True,
-    ).add_to(m)
+    m = folium.Map(location=[lat, lon], zoom_start=16, control_scale=True, tiles=None, prefer_canvas=True)
 
+    # Nur den gewählten Basemap-Layer laden (ohne Key):
+    # ein Layer weniger = weniger Tile-Requests und schnellerer Leaflet-Start.
     if tile_style == "Satellit (Esri)":
-        # initial layer selection: not perfect in folium, but we can add layers then user can toggle
-        pass
+        # Satellit (Esri) public tiles; Nutzung gemäß Esri/ArcGIS Terms
+        folium.TileLayer(
+            tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+            name="Satellit (Esri)",
+            attr="Tiles © Esri — Source: Esri, Maxar, Earthstar Geographics, and the GIS User Community",
+            control=False,
+        ).add_to(m)
+    else:
+        folium.TileLayer(
+            tiles="OpenStreetMap",
+            name="OpenStreetMap",
+            control=False,
+        ).add_to(m)
 
     folium.Marker([lat, lon], tooltip="Anlage", icon=folium.Icon(color="red", icon="info-sign")).add_to(m)
-    folium.LayerControl(collapsed=True).add_to(m)
     return m
 
 
+@st.fragment
+def render_map_fragment(lat: float, lon: float, tile_style: str, site_id: int):
+    # Fragment: die Karte wird nicht bei jedem Rerun (z. B. Tippen im
+    # AVV-Feld) neu aufgebaut, sondern nur bei eigenen Interaktionen.
+    m = make_map(lat, lon, tile_style)
+    st_folium(m, use_container_width=True, height=460, key=f"map-{site_id}-{tile_style}")
+
+
 # ----------------------------
 # App
 # ----------------------------
@@ -329,8 +416,9 @@ if not os.path.exists(db_path):
     st.stop()
 
 con = open_db(db_path)
-meta = db_get_meta(con)
-sites = db_list_sites(con)
+db_mtime = os.path.getmtime(db_path)
+meta = load_meta(db_path, db_mtime)
+sites, labels, label_to_site = load_sites(db_path, db_mtime)
 
 logo_bytes = load_logo_bytes()
 render_header(logo_bytes, meta.get("source_pdf", ""))
@@ -345,9 +433,6 @@ if not sites:
     )
     st.stop()
 
-labels = [build_site_label(s["ort"], s["bundesland"], s["annex"]) for s in sites]
-label_to_site = {labels[i]: sites[i] for i in range(len(sites))}
-
 tab_check, tab_standorte = st.tabs(["✅ Check", "📍 Standorte & AVV-Liste"])
 
 with tab_check:
@@ -387,6 +472,11 @@ with tab_check:
                         coords = nominatim_geocode(addr)
                     if coords:
                         lat, lon = coords
+                        # Koordinaten in die DB zurückschreiben, damit sie
+                        # App-Neustarts überleben (Nominatim-Rate-Limit schonen).
+                        con.execute("UPDATE sites SET lat=?, lon=? WHERE id=?", (lat, lon, int(site["id"])))
+                        con.commit()
+                        load_sites.clear()
                 except Exception as e:
                     st.warning(f"Geocoding fehlgeschlagen: {e}")
 
@@ -395,12 +485,15 @@ with tab_check:
                 st.markdown(f"[In OpenStreetMap öffnen](https://www.openstreetmap.org/search?query={requests.utils.quote(addr)})")
                 st.markdown(f"[In Google Maps öffnen](https://www.google.com/maps/search/?api=1&query={requests.utils.quote(addr)})")
             else:
-                m = make_map(float(lat), float(lon), tile_style)
-                st_folium(m, use_container_width=True, height=460)
+                render_map_fragment(float(lat), float(lon), tile_style, int(site["id"]))
 
         st.markdown("</div>", unsafe_allow_html=True)
 
-        rows_all = db_get_avv_for_site(con, int(site["id"]))
+        rows_all = load_avv_for_site(db_path, db_mtime, int(site["id"]))
+        avv_map = {r["code"]: r["text"] for r in rows_all}
+        # Einmal pro Standort lowercasen statt bei jedem Filter-Tastendruck.
+        rows_all_lower = [(str(r["code"]).lower(), (r["text"] or "").lower(), r["code"], r["text"] or "") for r in rows_all]
+        group_idx, chap_idx = build_prefix_index(rows_all)
         s1, s2 = st.columns(2)
         with s1:
             st.metric("Freigegebene AVV", value=len(rows_all))
@@ -418,7 +511,7 @@ with tab_check:
             st.markdown("</div>", unsafe_allow_html=True)
             st.stop()
 
-        match = db_find_avv(con, int(site["id"]), avv_norm)
+        match = {"code": avv_norm, "text": avv_map[avv_norm]} if avv_norm in avv_map else None
 
         if match:
             status_block(True, f"✅ POSITIV: {avv_norm}", f"Der AVV ist am Standort „{site_label}“ im EfB enthalten.")
@@ -429,28 +522,31 @@ with tab_check:
         else:
             status_block(False, f"❌ NEGATIV: {avv_norm}", f"Der AVV ist am Standort „{site_label}“ nicht aufgeführt.")
 
-            suggestions = suggest_similar(rows_all, avv_norm)
+            suggestions = suggest_similar(group_idx, chap_idx, avv_norm)
             if suggestions:
                 st.markdown("<div style='height:12px'></div>", unsafe_allow_html=True)
                 st.markdown("<div class='bc-kicker'>Ähnliche AVV am Standort (Hinweis)</div>", unsafe_allow_html=True)
-                st.dataframe(
-                    [{"AVV": r["code"], "Hinweis": (r["text"] or "")[:250]} for r in suggestions],
-                    use_container_width=True,
-                    hide_index=True,
+                st.markdown(
+                    render_small_table([{"AVV": r["code"], "Hinweis": (r["text"] or "")[:250]} for r in suggestions]),
+                    unsafe_allow_html=True,
                 )
 
         st.markdown("<div style='height:10px'></div>", unsafe_allow_html=True)
         with st.expander("Alle am Standort freigegebenen AVV anzeigen", expanded=False):
             filt = st.text_input("Filter (Code oder Text)", value="", key="filter_all_avv")
-            rows = rows_all
             if filt.strip():
                 f = filt.strip().lower()
-                rows = [r for r in rows if f in str(r["code"]).lower() or f in (r["text"] or "").lower()]
-            st.dataframe(
-                [{"AVV": r["code"], "Hinweis": r["text"] or ""} for r in rows],
-                use_container_width=True,
-                hide_index=True,
-            )
+                table_rows = [{"AVV": c, "Hinweis": t} for clow, tlow, c, t in rows_all_lower if f in clow or f in tlow]
+            else:
+                table_rows = [{"AVV": r["code"], "Hinweis": r["text"] or ""} for r in rows_all]
+            if len(table_rows) < 50:
+                st.markdown(render_small_table(table_rows), unsafe_allow_html=True)
+            else:
+                st.dataframe(
+                    table_rows,
+                    use_container_width=True,
+                    hide_index=True,
+                )
 
         st.markdown("</div>", unsafe_allow_html=True)
 
@@ -465,18 +561,16 @@ with tab_standorte:
     st.markdown("<div class='bc-title'>Standorte in der Datenbank</div>", unsafe_allow_html=True)
     st.markdown("<div class='bc-sub'>Übersicht inkl. AVV-Anzahl und Adresse.</div>", unsafe_allow_html=True)
 
-    overview = []
-    for s in sites:
-        rows = db_get_avv_for_site(con, int(s["id"]))
-        overview.append(
-            {
-                "Standort": (s["ort"] or "—"),
-                "BL": (s["bundesland"] or ""),
-                "Anlage": s["annex"],
-                "Seiten": f"{s['pages_start']}–{s['pages_end']}",
-                "AVV-Anzahl": len(rows),
-                "Adresse": full_address(s["strasse"], s["plz"], s["ort"], s["bundesland"]),
-            }
-        )
+    overview = [
+        {
+            "Standort": (r["ort"] or "—"),
+            "BL": (r["bundesland"] or ""),
+            "Anlage": r["annex"],
+            "Seiten": f"{r['pages_start']}–{r['pages_end']}",
+            "AVV-Anzahl": r["n"],
+            "Adresse": full_address(r["strasse"], r["plz"], r["ort"], r["bundesland"]),
+        }
+        for r in db_overview(con)
+    ]
     st.dataframe(overview, use_container_width=True, hide_index=True)
     st.markdown("</div>", unsafe_allow_html=True)
@@ -11,26 +11,22 @@ import datetime as dt
 import json
 import re
 import sqlite3
+import time
+from functools import lru_cache
 from typing import Dict, List, Optional, Tuple
 
 import fitz  # PyMuPDF
+import requests
 
 
-def normalize_avv(s: str) -> Optional[str]:
-    digits = re.sub(r"\D", "", s or "")
-    if len(digits) == 6:
-        return digits
-    if len(digits) == 5:
-        return digits.zfill(6)
-    return None
-
-
-def parse_codes_with_context(text: str) -> List[Dict[str, str]]:
-    lines = [ln.strip() for ln in text.splitlines()]
-    entries: List[Dict[str, str]] = []
-    current: Optional[Dict[str, str]] = None
+_NON_DIGIT = re.compile(r"\D")
+_CODE_ONLY = re.compile(r"^(\d{2}\s?\d{2}\s?\d{2}|\d{6})(\*?)$")
+_CODE_WITH_TAIL = re.compile(r"^(\d{2}\s?\d{2}\s?\d{2}|\d{6})(\*?)\s+(.+)$")
+_CODE_ANY = re.compile(r"^(\d{2}\s?\d{2}\s?\d{2}|\d{6})(\*?)\s*(.*)$")
+_BLOCK_SPLIT = re.compile(r"\nSeite|\n2\. |\nAnlage \d+ zum Zertifikat")
 
-    ignore = {
+_IGNORE_LINES = frozenset(
+    {
         "Abfallschlüssel",
         "(ggf. mit „*“-Eintrag)",
         "Abfallbezeichnung",
@@ -45,6 +41,39 @@ def parse_codes_with_context(text: str) -> List[Dict[str, str]]:
         "alle gefährlichen Abfälle",
         "bestimmte Abfallarten",
     }
+)
+
+
+_ANNEX_START = re.compile(r"Anlage\s+(\d+)\s+zum Zertifikat")
+
+_STANDORT_PATTERNS = {
+    "bezeichnung": re.compile(r"1\.1\s+Bezeichnung des Standorts:\s*(.+)"),
+    "strasse": re.compile(r"1\.2\s+Straße:\s*(.+)"),
+    "plz": re.compile(r"Postleitzahl:\s*(\d{4,5})"),
+    "ort": re.compile(r"Ort:\s*([A-Za-zÄÖÜäöüß\-/\.\s]+)"),
+    "bundesland": re.compile(r"Bundesland:\s*([A-Z]{2})"),
+}
+_TAETIGKEIT = re.compile(r"3\.\s+Beschreibung.*?:\s*\n(.+?)(?:\nSeite|\n4\.)", re.S)
+
+
+@lru_cache(maxsize=None)
+def _beiblatt_pattern(annex_no: int) -> "re.Pattern[str]":
+    return re.compile(rf"Beiblatt Einschränkungen/Bemerkungen\s+{annex_no}.*?\n")
+
+
+def normalize_avv(s: str) -> Optional[str]:
+    digits = _NON_DIGIT.sub("", s or "")
+    if len(digits) == 6:
+        return digits
+    if len(digits) == 5:
+        return digits.zfill(6)
+    return None
+
+
+def parse_codes_with_context(text: str) -> List[Dict[str, str]]:
+    lines = [ln.strip() for ln in text.splitlines()]
+    entries: List[Dict[str, str]] = []
+    current: Optional[Dict[str, str]] = None
 
     for ln in lines:
         if not ln:
@@ -52,7 +81,7 @@ def parse_codes_with_context(text: str) -> List[Dict[str, str]]:
         if ln.startswith("Seite "):
             continue
 
-        m = re.match(r"^(\d{2}\s?\d{2}\s?\d{2}|\d{6})(\*?)$", ln)
+        m = _CODE_ONLY.match(ln)
         if m:
             code = normalize_avv(m.group(1))
             if code and 1 <= int(code[:2]) <= 20:
@@ -61,7 +90,7 @@ def parse_codes_with_context(text: str) -> List[Dict[str, str]]:
                 current = {"code": code, "text": ""}
             continue
 
-        m = re.match(r"^(\d{2}\s?\d{2}\s?\d{2}|\d{6})(\*?)\s+(.+)$", ln)
+        m = _CODE_WITH_TAIL.match(ln)
         if m:
             code = normalize_avv(m.group(1))
             if code and 1 <= int(code[:2]) <= 20:
@@ -71,7 +100,7 @@ def parse_codes_with_context(text: str) -> List[Dict[str, str]]:
             continue
 
         if current:
-            if ln in ignore:
+            if ln in _IGNORE_LINES:
                 continue
             current["text"] = (current["text"] + " " + ln).strip()
 
@@ -89,13 +118,12 @@ def parse_codes_with_context(text: str) -> List[Dict[str, str]]:
 
 def parse_beiblatt(text: str, annex_no: int) -> Dict[str, str]:
     beiblatt: Dict[str, str] = {}
-    pattern = r"Beiblatt Einschränkungen/Bemerkungen\s+" + str(annex_no) + r".*?\n"
-    parts = re.split(pattern, text)
+    parts = _beiblatt_pattern(annex_no).split(text)
     if len(parts) <= 1:
         return {}
 
     for part in parts[1:]:
-        block = re.split(r"\nSeite|\n2\. |\nAnlage \d+ zum Zertifikat", part)[0]
+        block = _BLOCK_SPLIT.split(part)[0]
         lines = [ln.strip() for ln in block.splitlines()]
 
         current: Optional[str] = None
@@ -104,7 +132,7 @@ def parse_beiblatt(text: str, annex_no: int) -> Dict[str, str]:
         for ln in lines:
             if not ln:
                 continue
-            m = re.match(r"^(\d{2}\s?\d{2}\s?\d{2}|\d{6})(\*?)\s*(.*)$", ln)
+            m = _CODE_ANY.match(ln)
             code = normalize_avv(m.group(1)) if m else None
             if code:
                 if current:
@@ -122,35 +150,59 @@ def parse_beiblatt(text: str, annex_no: int) -> Dict[str, str]:
     return {k: v for k, v in beiblatt.items() if v}
 
 
-def extract_annex_start_pages(doc: "fitz.Document") -> List[Tuple[int, int]]:
+def extract_annex_start_pages(doc: "fitz.Document", pages: List[str]) -> List[Tuple[int, int]]:
+    # Bevorzugt das PDF-Inhaltsverzeichnis (praktisch kostenlos); nur PDFs
+    # ohne Outline brauchen den Regex-Scan über die Seitentexte.
     occ = []
-    for i in range(len(doc)):
-        txt = doc[i].get_text("text")
-        m = re.search(r"Anlage\s+(\d+)\s+zum Zertifikat", txt)
+    try:
+        toc = doc.get_toc(simple=True)
+    except Exception:
+        toc = []
+    # Strikt auf "Anlage N zum Zertifikat" matchen: die Outline enthält auch
+    # Beiblatt-Einträge ("Beiblatt zu Anlage N"), die sonst die Seitenbereiche
+    # der echten Anlagen zerschneiden würden. Pro Anlage zählt die erste Seite.
+    seen = set()
+    for _level, title, page in toc:
+        m = _ANNEX_START.search(title)
+        if m and page > 0:
+            annex_no = int(m.group(1))
+            if annex_no not in seen:
+                seen.add(annex_no)
+                occ.append((annex_no, page))
+    if occ:
+        return sorted(occ)
+
+    for i, txt in enumerate(pages):
+        m = _ANNEX_START.search(txt)
         if m:
             occ.append((int(m.group(1)), i + 1))
     return sorted(occ)
 
 
-def parse_annex(doc: "fitz.Document", annex_no: int, start_page: int, end_page: int) -> Dict:
-    text = "\n".join(doc[p - 1].get_text("text") for p in range(start_page, end_page + 1))
+def parse_annex(pages: List[str], annex_no: int, start_page: int, end_page: int) -> Dict:
+    text = "\n".join(pages[start_page - 1:end_page])
+    # Die Standortfelder (Abschnitt 1.x) stehen auf der ersten Annex-Seite;
+    # erst dort suchen, statt jedes Pattern über den ganzen Annex laufen zu lassen.
+    head = pages[start_page - 1]
 
-    def extract(pattern: str) -> Optional[str]:
-        m = re.search(pattern, text)
+    def extract(pat: "re.Pattern[str]") -> Optional[str]:
+        m = pat.search(head) or pat.search(text)
         return m.group(1).strip() if m else None
 
     standort = {
-        "bezeichnung": extract(r"1\.1\s+Bezeichnung des Standorts:\s*(.+)"),
-        "strasse": extract(r"1\.2\s+Straße:\s*(.+)"),
-        "plz": extract(r"Postleitzahl:\s*(\d{4,5})"),
-        "ort": (extract(r"Ort:\s*([A-Za-zÄÖÜäöüß\-/\.\s]+)") or "").strip() or None,
-        "bundesland": extract(r"Bundesland:\s*([A-Z]{2})"),
+        "bezeichnung": extract(_STANDORT_PATTERNS["bezeichnung"]),
+        "strasse": extract(_STANDORT_PATTERNS["strasse"]),
+        "plz": extract(_STANDORT_PATTERNS["plz"]),
+        "ort": (extract(_STANDORT_PATTERNS["ort"]) or "").strip() or None,
+        "bundesland": extract(_STANDORT_PATTERNS["bundesland"]),
     }
 
-    m = re.search(r"3\.\s+Beschreibung.*?:\s*\n(.+?)(?:\nSeite|\n4\.)", text, flags=re.S)
+    m = _TAETIGKEIT.search(text)
     taetigkeit = " ".join(line.strip() for line in m.group(1).splitlines() if line.strip()) if m else None
 
-    codes = parse_codes_with_context(text)
+    # Die AVV-Tabelle beginnt mit Abschnitt 4; nur ab dort zeilenweise parsen.
+    idx = text.find("4. Abfallarten")
+    codes = parse_codes_with_context(text[idx:] if idx != -1 else text)
     beiblatt = parse_beiblatt(text, annex_no)
 
     avv = []
@@ -176,12 +228,41 @@ def is_biogas_site(taetigkeit: Optional[str]) -> bool:
     return any(k in d for k in ["biogasanlage", "vergärungsanlage", "trockenvergärung", "nass-", "abfallvergärungsanlage"])
 
 
+def nominatim_geocode(address: str) -> Optional[Tuple[float, float]]:
+    url = "https://nominatim.openstreetmap.org/search"
+    headers = {"User-Agent": "EfB-AVV-Checker/1.0 (internal use)"}
+    r = requests.get(url, params={"q": address, "format": "json", "limit": 1}, headers=headers, timeout=20)
+    r.raise_for_status()
+    data = r.json()
+    if not data:
+        return None
+    return float(data[0]["lat"]), float(data[0]["lon"])
+
+
+def geocode_sites(sites: List[Dict]) -> None:
+    # Koordinaten schon beim Seeden ermitteln, damit die App Nominatim
+    # gar nicht mehr anfragen muss. Rate-Limit: max. 1 Request/Sekunde.
+    for s in sites:
+        stnd = s["standort"]
+        parts = [stnd.get("strasse"), " ".join(p for p in [stnd.get("plz"), stnd.get("ort")] if p), "Deutschland"]
+        address = ", ".join(p for p in parts if p)
+        try:
+            coords = nominatim_geocode(address)
+        except Exception as e:
+            print(f"Geocoding fehlgeschlagen für {address!r}: {e}")
+            coords = None
+        if coords:
+            s["lat"], s["lon"] = coords
+        time.sleep(1)
+
+
 def build_db(out_path: str, source_pdf: str, sites: List[Dict]):
     con = sqlite3.connect(out_path)
     cur = con.cursor()
+    # Bulk-Load: fsync/Journal während des Seedens aus, am Ende zurück auf WAL.
+    cur.executescript("PRAGMA synchronous=OFF; PRAGMA temp_store=MEMORY; PRAGMA journal_mode=MEMORY;")
     cur.executescript(
         """
-        PRAGMA journal_mode=WAL;
         DROP TABLE IF EXISTS meta;
         DROP TABLE IF EXISTS sites;
         DROP TABLE IF EXISTS avv;
@@ -211,12 +292,14 @@ def build_db(out_path: str, source_pdf: str, sites: List[Dict]):
           FOREIGN KEY(site_id) REFERENCES sites(id)
         );
 
-        CREATE INDEX idx_avv_site_code ON avv(site_id, code);
+        -- Genau eine Zeile pro (site_id, code).
+        CREATE UNIQUE INDEX idx_avv_site_code ON avv(site_id, code);
         """
     )
     cur.execute("INSERT INTO meta(k,v) VALUES (?,?)", ("source_pdf", source_pdf))
-    cur.execute("INSERT INTO meta(k,v) VALUES (?,?)", ("generated_at_utc", dt.datetime.utcnow().isoformat(timespec="seconds") + "Z"))
+    cur.execute("INSERT INTO meta(k,v) VALUES (?,?)", ("generated_at_utc", dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")))
 
+    avv_rows: List[Tuple[int, Optional[str], Optional[str]]] = []
     for s in sites:
         stnd = s["standort"]
         cur.execute(
@@ -234,14 +317,15 @@ def build_db(out_path: str, source_pdf: str, sites: List[Dict]):
                 stnd.get("ort"),
                 stnd.get("bundesland"),
                 s.get("taetigkeit"),
-                None,
-                None,
+                s.get("lat"),
+                s.get("lon"),
             ),
         )
         site_id = cur.lastrowid
-        for row in s.get("avv", []):
-            cur.execute("INSERT INTO avv(site_id,code,text) VALUES (?,?,?)", (site_id, row.get("code"), row.get("text")))
+        avv_rows.extend((site_id, row.get("code"), row.get("text")) for row in s.get("avv", []))
+    cur.executemany("INSERT INTO avv(site_id,code,text) VALUES (?,?,?)", avv_rows)
     con.commit()
+    cur.execute("PRAGMA journal_mode=WAL")
     con.close()
 
 
@@ -250,18 +334,25 @@ def main():
     ap.add_argument("--pdf", required=True, help="Pfad zur EfB-PDF")
     ap.add_argument("--out", default="efb_avv.db", help="Ausgabe DB (SQLite)")
     ap.add_argument("--source", default="", help="Optionale Quellenbeschreibung (z. B. Zertifikatsnummer)")
+    ap.add_argument("--geocode", action="store_true", help="Standorte beim Seeden via Nominatim geocodieren")
     args = ap.parse_args()
 
     doc = fitz.open(args.pdf)
 
-    occ = extract_annex_start_pages(doc)
+    # Jede Seite nur einmal durch PyMuPDF extrahieren, danach nur noch slicen.
+    pages = [doc[i].get_text("text") for i in range(len(doc))]
+
+    occ = extract_annex_start_pages(doc, pages)
     annexes = []
     for idx, (annex_no, start_pg) in enumerate(occ):
-        end_pg = (occ[idx + 1][1] - 1) if idx + 1 < len(occ) else len(doc)
-        annexes.append(parse_annex(doc, annex_no, start_pg, end_pg))
+        end_pg = (occ[idx + 1][1] - 1) if idx + 1 < len(occ) else len(pages)
+        annexes.append(parse_annex(pages, annex_no, start_pg, end_pg))
 
     biogas = [a for a in annexes if is_biogas_site(a.get("taetigkeit"))]
 
+    if args.geocode:
+        geocode_sites(biogas)
+
     source = args.source.strip() or os.path.basename(args.pdf)
     build_db(args.out, source, biogas)
     print(f"DB erstellt: {args.out} (Standorte: {len(biogas)})")